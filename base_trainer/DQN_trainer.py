@@ -43,7 +43,7 @@ class DQN_Trainer(nn.Module):
                 # found, so we pick action with the larger expected reward.
                 state = torch.tensor(observation['real_obs'], dtype=torch.float32, device=self.device).unsqueeze(0)
                 action_logits = self.policy_net(state)
-                inf_mask = torch.log(torch.tensor(observation['action_mask']))
+                inf_mask = torch.log(torch.tensor(observation['action_mask'], dtype=torch.float32))
                 masked_logits = inf_mask + action_logits
                 return masked_logits.max(1)[1].view(1, 1)
         else:
@@ -35,11 +35,11 @@ class REINFORCE_Trainer():
                 # found, so we pick action with the larger expected reward.
                 state = torch.tensor(observation['real_obs'], dtype=torch.float32, device=self.device).unsqueeze(0)
                 action_logits = self.policy_net(state)
-                inf_mask = torch.log(torch.tensor(observation['action_mask']))
+                inf_mask = torch.log(torch.tensor(observation['action_mask'], dtype=torch.float32))
                 masked_logits = inf_mask + action_logits
                 return masked_logits.max(1)[1].view(1, 1)
         else:
-            valid_actions = [item for item in range(self.env.offline + 1) if observation['action_mask'][item]]
+            valid_actions = np.flatnonzero(observation['action_mask'])
             return torch.tensor([[np.random.choice(valid_actions)]], device=self.device, dtype=torch.long)
 
     def select_action_val(self, observation):
@@ -49,7 +49,7 @@ class REINFORCE_Trainer():
             # found, so we pick action with the larger expected reward.
             state = torch.tensor(observation['real_obs'], dtype=torch.float32, device=self.device).unsqueeze(0)
             action_logits = self.policy_net(state)
-            inf_mask = torch.log(torch.tensor(observation['action_mask']))
+            inf_mask = torch.log(torch.tensor(observation['action_mask'], dtype=torch.float32))
             masked_logits = inf_mask + action_logits
             return masked_logits.max(1)[1].view(1, 1)
 
@@ -123,8 +123,9 @@ class REINFORCE_Trainer():
 
                 action = self.select_action(s_0).item()
 
+                # the env updates its observation in place, keep a copy of the current state
+                states.append(s_0['real_obs'].copy())
                 s_1, reward, done, _ = self.env.step(action)
-                states.append(s_0['real_obs'])
                 rewards.append(reward)
                 actions.append(action)
                 s_0 = s_1
@@ -188,8 +189,8 @@ class REINFORCE_Trainer():
         done = False
         while done == False:
             action = self.select_action(s_0)
+            states.append(s_0['real_obs'].copy())
             s_1, reward, done, _ = self.env.step(action)
-            states.append(s_0['real_obs'])
             rewards.append(reward)
             actions.append(action)
         return sum(rewards)
@@ -1,10 +1,27 @@
+import logging
+
 import gymnasium as gym
 import numpy as np
 from gymnasium import spaces
 
+from utils import make_rng, masked_obs_buffer, njit, prange
+
+try:
+    # optional compiled step core, build it with `cythonize -i environment_c.pyx`
+    from environment_c import BinPackingCore
+except ImportError:
+    BinPackingCore = None
+
 BIG_NEG_REWARD = -100
 BIG_POS_REWARD = 10
 
+# outcomes of inserting an item, see _bp_step_core
+ITEM_PLACED = 0
+BIN_OVERFLOW = 1
+NO_BIN_AT_LEVEL = 2
+
+logger = logging.getLogger(__name__)
+
 """
 STATE:
 Number of bags at each level
@@ -13,6 +30,73 @@ ACTION:
 Choose bag
 """
 
+
+@njit(cache=True)
+def _bp_step_core(num_bins_levels, action, item_size, bag_capacity, waste, num_full_bags):
+    # insert the item into a bag of level `action` (0 opens a new bag), updating num_bins_levels in place
+    # returns reward, num_full_bags, waste and the outcome of the insertion
+    if action > (bag_capacity - item_size):
+        # can't insert item because bin overflow
+        return BIG_NEG_REWARD - waste, num_full_bags, waste, BIN_OVERFLOW
+    elif action == 0:  # new bag
+        num_bins_levels[item_size] += 1
+        # waste = sum of empty spaces in all bags
+        waste = bag_capacity - item_size
+    elif num_bins_levels[action] == 0:
+        # can't insert item because bin of this level doesn't exist
+        return BIG_NEG_REWARD - waste, num_full_bags, waste, NO_BIN_AT_LEVEL
+    else:
+        if action + item_size == bag_capacity:
+            num_full_bags += 1
+        else:
+            num_bins_levels[action + item_size] += 1
+        num_bins_levels[action] -= 1
+        # waste = empty space in the bag
+        waste = -item_size
+    # reward is negative waste
+    return -1 * waste, num_full_bags, waste, ITEM_PLACED
+
+
+@njit(cache=True)
+def _bp_step_mask_core(state, mask, fit_mask, action, item_size, next_item, bag_capacity, waste, num_full_bags):
+    # _bp_step_core, then write the next item into the state and its action mask in the same pass
+    num_bins_levels = state[:bag_capacity]
+    reward, num_full_bags, waste, outcome = _bp_step_core(
+        num_bins_levels, action, item_size, bag_capacity, waste, num_full_bags)
+    state[bag_capacity] = next_item
+    # get bin levels for which bins exist and the next item will fit, as one array expression so that it
+    # stays vectorized when numba is not installed
+    mask[:] = fit_mask[next_item] & (num_bins_levels > 0)
+    mask[0] = 1  # open new bag
+    return reward, num_full_bags, waste, outcome
+
+
+@njit(cache=True, parallel=True)
+def _vec_bp_step(states, actions, bag_capacity, time_horizon, waste, num_full_bags, time_remaining,
+                 item_stream, stream_idx, rewards, dones):
+    # one step of every env, each row of states is the state of one env
+    for i in prange(states.shape[0]):
+        levels = states[i, :bag_capacity]
+        reward, full_bags, env_waste, outcome = _bp_step_core(
+            levels, actions[i], np.int64(states[i, bag_capacity]), bag_capacity, waste[i], num_full_bags[i])
+        rewards[i] = reward
+        num_full_bags[i] = full_bags
+        waste[i] = env_waste
+
+        time_remaining[i] -= 1
+        dones[i] = outcome != ITEM_PLACED or time_remaining[i] == 0
+        if dones[i]:
+            # reset finished envs right away
+            levels[:] = 0
+            waste[i] = 0
+            num_full_bags[i] = 0
+            time_remaining[i] = time_horizon
+
+        # get the next item, for finished envs this is the first item of the new episode
+        states[i, bag_capacity] = item_stream[i, stream_idx[i]]
+        stream_idx[i] += 1
+
+
 class BinPackingGymEnvironment(gym.Env):
 
     def __init__(self, env_config={}):
@@ -31,71 +115,85 @@ class BinPackingGymEnvironment(gym.Env):
             self.__dict__[key] = val  # Creates variables like self.plot_boxes, self.save_files, etc
             if key not in env_config:
                 env_config[key] = val
-        print('Using bin size: ', self.bag_capacity)
-        print('Using items sizes {} \nWith item probabilities {}'.format(self.item_sizes, self.item_probabilities))
-        self.csv_file = '/Users/jianqiaolu/discuss with zhiyi/rl/binpacking.csv'
+        if env_config.get('verbose', 0) > 0:
+            print('Using bin size: ', self.bag_capacity)
+            print('Using items sizes {} \nWith item probabilities {}'.format(self.item_sizes, self.item_probabilities))
 
         self.episode_count = 0
 
+        # invalid actions are only counted, set 'debug' to also log them
+        self._debug = env_config.get('debug', False)
+        self._invalid_count = 0
+
+        # items are drawn in batches from a single generator, see __get_item
+        self._rng = make_rng(env_config.get('seed'))
+        self._item_probs = np.asarray(self.item_probabilities)
+        self._item_sizes_arr = np.asarray(self.item_sizes, dtype=np.int64)
+
         # state: number of bags at each level, item size,
-        self.observation_space = spaces.Box(low=np.array([0] * self.bag_capacity + [0]), high=np.array(
-            [self.time_horizon] * self.bag_capacity + [max(self.item_sizes)]), dtype=np.uint32)
+        high = np.full(self.bag_capacity + 1, self.time_horizon, dtype=np.uint32)
+        high[-1] = max(self.item_sizes)
+        self.observation_space = spaces.Box(low=np.zeros(self.bag_capacity + 1, dtype=np.uint32), high=high,
+                                            dtype=np.uint32)
 
         # actions: select a bag from the different levels possible
         self.action_space = spaces.Discrete(self.bag_capacity)
 
+        # the state is kept in one preallocated buffer that is updated in place:
+        # number of bags at each level followed by the item size.
+        # NOTE: reset/step return this buffer, copy it if it has to survive the next step
+        self._state = np.zeros(self.bag_capacity + 1, dtype=np.uint32)
+        self.num_bins_levels = self._state[:-1]
+        # bin levels, used to vectorize the checks over all levels
+        self._indices = np.arange(self.action_space.n, dtype=np.int64)
+        # lookup tables indexed by item size: the highest level the item still fits in,
+        # and the mask of levels the item fits in
+        self._max_action_for_item = self.bag_capacity - np.arange(max(self.item_sizes) + 1)
+        self._fit_mask = self._indices[np.newaxis, :] <= self._max_action_for_item[:, np.newaxis]
+        # bin types are packed ints holding the count of each item size in its own bit field,
+        # a field is wide enough for any count that fits in the bag
+        self._bin_type_bits = int(self.bag_capacity).bit_length()
+
     def reset(self):
         self.time_remaining = self.time_horizon
+        # one item for the initial state and one after every step
+        self.__draw_items(self.time_horizon + 1)
         self.item_size = self.__get_item()
         self.num_full_bags = 0
 
         # an array of size bag capacity that keeps track of
         # number of bags at each level
-        self.num_bins_levels = [0] * self.bag_capacity
+        self._state.fill(0)
+        self._state[-1] = self.item_size
 
-        initial_state = self.num_bins_levels + [self.item_size]
+        initial_state = self._state
         self.total_reward = 0
         self.waste = 0
         self.episode_count += 1
         self.bin_type_distribution_map = {}  # level to bin types, to the # of bins for each bin type.
+        self._bin_type_keys = {}  # level to the list of bin types in bin_type_distribution_map, for sampling
         self.step_count = 0
+        self._invalid_count = 0
+        if BinPackingCore is not None:
+            self._core = BinPackingCore(self.num_bins_levels, self.bag_capacity)
         return initial_state
 
     def step(self, action):
         done = False
         self.step_count += 1
         if action >= self.bag_capacity:
-            print("Error: Invalid Action")
-            raise
-        elif action > (self.bag_capacity - self.item_size):
-            # can't insert item because bin overflow
-            reward = BIG_NEG_REWARD - self.waste
-            done = True
-        elif action == 0:  # new bag
-            self.num_bins_levels[self.item_size] += 1
-            # waste = sum of empty spaces in all bags
-            self.waste = self.bag_capacity - self.item_size
-            # reward is negative waste
-            reward = -1 * self.waste
-            self.__update_bin_type_distribution_map(0)
-        elif self.num_bins_levels[action] == 0:
-            # can't insert item because bin of this level doesn't exist
-            print('cannot insert item because bin of this level does not exist')
-            reward = BIG_NEG_REWARD - self.waste
-            done = True
+            raise ValueError(f"Invalid action {action}")
+
+        if BinPackingCore is not None:
+            reward, self.num_full_bags, self.waste, outcome = self._core.step(action, self.item_size)
         else:
-            if action + self.item_size == self.bag_capacity:
-                self.num_full_bags += 1
-            else:
-                self.num_bins_levels[action + self.item_size] += 1
-            # waste = empty space in the bag
-            self.waste = -self.item_size
-            # reward is negative waste
-            reward = -1 * self.waste
+            reward, self.num_full_bags, self.waste, outcome = _bp_step_core(
+                self.num_bins_levels, action, self.item_size, self.bag_capacity, self.waste, self.num_full_bags)
+        if outcome == ITEM_PLACED:
             self.__update_bin_type_distribution_map(action)
-            if self.num_bins_levels[action] < 0:
-                print(self.num_bins_levels[action])
-            self.num_bins_levels[action] -= 1
+        else:
+            self._log_invalid_action(action, outcome)
+            done = True
 
         self.total_reward += reward
 
@@ -106,59 +204,93 @@ class BinPackingGymEnvironment(gym.Env):
         # get the next item
         self.item_size = self.__get_item()
         # state is the number of bins at each level and the item size
-        state = self.num_bins_levels + [self.item_size]
-        info = self.bin_type_distribution_map
+        self._state[-1] = self.item_size
+        state = self._state
+        info = self._get_info()
 
 
         return state, reward, done, info
 
+    def __draw_items(self, num_draws):
+        item_indices = self._rng.choice(len(self.item_sizes), size=num_draws, p=self._item_probs)
+        self._size_stream = self._item_sizes_arr[item_indices]
+        self._stream_idx = 0
+
     def __get_item(self):
-        num_items = len(self.item_sizes)
-        item_index = np.random.choice(num_items, p=self.item_probabilities)
-        return self.item_sizes[item_index]
+        if self._stream_idx == len(self._size_stream):
+            # stepping past the time horizon, draw another batch
+            self.__draw_items(self.time_horizon + 1)
+        item_size = int(self._size_stream[self._stream_idx])
+        self._stream_idx += 1
+        return item_size
 
     def __update_bin_type_distribution_map(self, target_bin_util):
         if target_bin_util < 0 or target_bin_util + self.item_size > self.bag_capacity:
-            print("Error: Invalid Bin Utilization/Item Size")
+            if self._debug:
+                logger.debug("Invalid Bin Utilization/Item Size")
             return
         elif target_bin_util > 0 and target_bin_util not in self.bin_type_distribution_map:
-            print("Error: bin_type_distribution_map does not contain " + str(target_bin_util) + " as key!")
+            if self._debug:
+                logger.debug("bin_type_distribution_map does not contain %s as key!", target_bin_util)
             return
         elif target_bin_util > 0 and target_bin_util in self.bin_type_distribution_map and len(
                 self.bin_type_distribution_map[target_bin_util]) == 0:
-            print("Error: bin_type_distribution_map has no element at level " + str(target_bin_util) + " !")
+            if self._debug:
+                logger.debug("bin_type_distribution_map has no element at level %s !", target_bin_util)
             return
         elif target_bin_util == 0:  # opening a new bin
-            if self.item_size not in self.bin_type_distribution_map:
-                self.bin_type_distribution_map[self.item_size] = {str(self.item_size): 1}
-            elif str(self.item_size) not in self.bin_type_distribution_map[self.item_size]:
-                self.bin_type_distribution_map[self.item_size][str(self.item_size)] = 1
-            else:
-                self.bin_type_distribution_map[self.item_size][str(self.item_size)] += 1
+            self.__add_bin_type(self.item_size, 1 << (self._bin_type_bits * self.item_size))
         else:
-            key = np.random.choice(list(self.bin_type_distribution_map[target_bin_util].keys()))
-            if self.bin_type_distribution_map[target_bin_util][key] <= 0:
-                print("Error: Invalid bin count!")
+            level_bin_types = self.bin_type_distribution_map[target_bin_util]
+            level_keys = self._bin_type_keys[target_bin_util]
+            key_index = self._rng.integers(len(level_keys))
+            key = level_keys[key_index]
+            if level_bin_types[key] <= 0:
+                if self._debug:
+                    logger.debug("Invalid bin count!")
                 return
-            elif self.bin_type_distribution_map[target_bin_util][key] == 1:
-                del self.bin_type_distribution_map[target_bin_util][key]
+            elif level_bin_types[key] == 1:
+                del level_bin_types[key]
+                # swap the last key into the removed slot
+                level_keys[key_index] = level_keys[-1]
+                level_keys.pop()
             else:
-                self.bin_type_distribution_map[target_bin_util][key] -= 1
-
-            new_key = self.__update_key_for_bin_type_distribution_map(key, self.item_size)
-            if (target_bin_util + self.item_size) not in self.bin_type_distribution_map:
-                self.bin_type_distribution_map[target_bin_util + self.item_size] = {new_key: 1}
-            elif new_key not in self.bin_type_distribution_map[target_bin_util + self.item_size]:
-                self.bin_type_distribution_map[target_bin_util + self.item_size][new_key] = 1
+                level_bin_types[key] -= 1
+
+            new_key = key + (1 << (self._bin_type_bits * self.item_size))
+            self.__add_bin_type(target_bin_util + self.item_size, new_key)
+
+    def __add_bin_type(self, bin_util, key):
+        if bin_util not in self.bin_type_distribution_map:
+            self.bin_type_distribution_map[bin_util] = {key: 1}
+            self._bin_type_keys[bin_util] = [key]
+        elif key not in self.bin_type_distribution_map[bin_util]:
+            self.bin_type_distribution_map[bin_util][key] = 1
+            self._bin_type_keys[bin_util].append(key)
+        else:
+            self.bin_type_distribution_map[bin_util][key] += 1
+
+    def decode_bin_type(self, key):
+        # sorted tuple of the item sizes in a bin type of bin_type_distribution_map
+        field_mask = (1 << self._bin_type_bits) - 1
+        sizes = []
+        for size in range(1, self.bag_capacity + 1):
+            sizes.extend([size] * ((key >> (self._bin_type_bits * size)) & field_mask))
+        return tuple(sizes)
+
+    def _log_invalid_action(self, action, outcome):
+        self._invalid_count += 1
+        if self._debug:
+            if outcome == BIN_OVERFLOW:
+                logger.debug('cannot insert item of size %s at level %s because bin overflow', self.item_size, action)
             else:
-                self.bin_type_distribution_map[target_bin_util + self.item_size][new_key] += 1
+                logger.debug('cannot insert item because bin of level %s does not exist', action)
 
-    @staticmethod
-    def __update_key_for_bin_type_distribution_map(key, item_size):
-        parts = key.split(' ')
-        parts.append(str(item_size))
-        parts.sort()
-        return " ".join(parts)
+    def _get_info(self):
+        return {
+            'bin_type_distribution_map': self.bin_type_distribution_map,
+            'invalid_action_count': self._invalid_count,
+        }
 
     def render(self, mode="human", close=False):
         pass
@@ -169,33 +301,15 @@ class BinPackingIncrementalWasteGymEnvironment(BinPackingGymEnvironment):
     def step(self, action):
         done = False
         if action >= self.bag_capacity:
-            print("Error: Invalid Action")
-            raise
-        elif action > (self.bag_capacity - self.item_size):
-            # can't insert item because bin overflow
-            reward = BIG_NEG_REWARD - self.waste
-        elif action == 0:  # new bag
-            self.num_bins_levels[self.item_size] += 1
-            # waste = sum of empty spaces in all bags
-            self.waste = self.bag_capacity - self.item_size
-            # reward is negative waste
-            reward = -1 * self.waste
-            self.__update_bin_type_distribution_map(0)
-        elif self.num_bins_levels[action] == 0:
-            # can't insert item because bin of this level doesn't exist
-            print('cannot insert item because bin of this level does not exist')
-            reward = BIG_NEG_REWARD - self.waste
+            raise ValueError(f"Invalid action {action}")
+
+        # invalid actions are penalized but do not end the episode
+        reward, self.num_full_bags, self.waste, outcome = _bp_step_core(
+            self.num_bins_levels, action, self.item_size, self.bag_capacity, self.waste, self.num_full_bags)
+        if outcome == ITEM_PLACED:
+            self._BinPackingGymEnvironment__update_bin_type_distribution_map(action)
         else:
-            if action + self.item_size == self.bag_capacity:
-                self.num_full_bags += 1
-            else:
-                self.num_bins_levels[action + self.item_size] += 1
-            self.__update_bin_type_distribution_map(action)
-            self.num_bins_levels[action] -= 1
-            # waste = sum of empty spaces in all bags
-            self.waste = -self.item_size
-            # reward is negative waste
-            reward = -1 * self.waste
+            self._log_invalid_action(action, outcome)
 
         self.total_reward += reward
 
@@ -204,10 +318,11 @@ class BinPackingIncrementalWasteGymEnvironment(BinPackingGymEnvironment):
             done = True
 
         # get the next item
-        self.item_size = self.__get_item()
+        self.item_size = self._BinPackingGymEnvironment__get_item()
         # state is the number of bins at each level and the item size
-        state = self.num_bins_levels + [self.item_size]
-        info = self.bin_type_distribution_map
+        self._state[-1] = self.item_size
+        state = self._state
+        info = self._get_info()
         return state, reward, done, info
 
 
@@ -230,39 +345,24 @@ class BinPackingNearActionGymEnvironment(BinPackingGymEnvironment):
         # get the next item
         self.item_size = self._BinPackingGymEnvironment__get_item()
         # state is the number of bins at each level and the item size
-        state = self.num_bins_levels + [self.item_size]
-        info = self.bin_type_distribution_map
+        self._state[-1] = self.item_size
+        state = self._state
+        info = self._get_info()
         return state, reward, done, info
 
     def __insert_item(self, action):
-        if action == 0:  # new bag
-            self.num_bins_levels[self.item_size] += 1
-            # waste added by putting in new item
-            self.waste = self.bag_capacity - self.item_size
-        else:  # insert in existing bag
-            if action + self.item_size == self.bag_capacity:
-                self.num_full_bags += 1
-            else:
-                self.num_bins_levels[action + self.item_size] += 1
-            self.num_bins_levels[action] -= 1
-            # waste reduces as we insert item in existing bag
-            self.waste = -self.item_size
-        # reward is negative waste
-        reward = -1 * self.waste
+        # action is valid here: 0 opens a new bag, otherwise insert in existing bag
+        reward, self.num_full_bags, self.waste, _ = _bp_step_core(
+            self.num_bins_levels, action, self.item_size, self.bag_capacity, self.waste, self.num_full_bags)
         self._BinPackingGymEnvironment__update_bin_type_distribution_map(action)
         return reward
 
     def __get_nearest_valid_action(self, action):
-        num_actions = self.bag_capacity
-        # valid actions have
-        valid_actions = list()
-        for x in range(1, num_actions):
-            if self.num_bins_levels[x] > 0:
-                if x <= (self.bag_capacity - self.item_size):
-                    valid_actions.append(x)
-        if valid_actions:
+        # valid actions have an existing bin at that level and the item fits
+        valid_actions = np.flatnonzero(self._fit_mask[self.item_size, 1:] & (self.num_bins_levels[1:] > 0)) + 1
+        if valid_actions.size:
             # get nearest valid action
-            valid_action = min(valid_actions, key=lambda x: abs(x - action))
+            valid_action = int(valid_actions[np.abs(valid_actions - action).argmin()])
         else:
             valid_action = 0  # open new bag
 
@@ -270,16 +370,15 @@ class BinPackingNearActionGymEnvironment(BinPackingGymEnvironment):
 
     def __is_action_valid(self, action):
         if action >= self.bag_capacity:
-            print("Error: Invalid Action ", action)
-            raise
-        elif action > (self.bag_capacity - self.item_size):
+            raise ValueError(f"Invalid action {action}")
+        elif action > self._max_action_for_item[self.item_size]:
             # can't insert item because bin overflow
-            print('cannot insert item because bin overflow')
+            self._log_invalid_action(action, BIN_OVERFLOW)
             return False
         elif action == 0:  # new bag
             return True
         elif self.num_bins_levels[action] == 0:
-            print('cannot insert item because bin of this level does not exist')
+            self._log_invalid_action(action, NO_BIN_AT_LEVEL)
             return False
         else:  # insert in existing bag
             return True
@@ -309,41 +408,130 @@ class BinPackingActionMaskGymEnvironment(BinPackingNearActionGymEnvironment):
                 0,
                 1,
                 shape=(self.action_space.n,),
-                dtype=np.float32),
+                dtype=np.uint8),
             "real_obs": self.observation_space
         })
+        # mask and state share one buffer, see masked_obs_buffer, the state part replaces the buffer
+        # allocated by the base class so steps update the observation in place
+        self._obs_buf, self._mask, self._state = masked_obs_buffer(self.action_space.n, self.bag_capacity + 1,
+                                                                   np.uint32)
+        self.num_bins_levels = self._state[:-1]
+        self._obs = {
+            "action_mask": self._mask,
+            "real_obs": self._state,
+        }
 
     def reset(self):
-        state = super().reset()
-        valid_actions = self.__get_valid_actions()
-        self.action_mask = [1 if x in valid_actions else 0 for x in range(self.action_space.n)]
-        obs = {
-            "action_mask": np.array(self.action_mask),
-            "real_obs": np.array(state),
-        }
+        super().reset()
+        self.__get_valid_actions()
 
-        return obs
+        return self._obs
 
     def step(self, action):
-        state, rew, done, info = super().step(action)
+        done = False
+        invalid_action = not (self._BinPackingNearActionGymEnvironment__is_action_valid(action))
+        if invalid_action:
+            action = self._BinPackingNearActionGymEnvironment__get_nearest_valid_action(action)
 
-        valid_actions = self.__get_valid_actions()
-        self.action_mask = [1 if x in valid_actions else 0 for x in range(self.action_space.n)]
-        obs = {
-            "action_mask": np.array(self.action_mask),
-            "real_obs": np.array(state),
-        }
-        return obs, rew, done, info
+        # insert the item, then write the next item and the new action mask in one kernel call
+        next_item_size = self._BinPackingGymEnvironment__get_item()
+        reward, self.num_full_bags, self.waste, _ = _bp_step_mask_core(
+            self._state, self._mask, self._fit_mask, action, self.item_size, next_item_size, self.bag_capacity,
+            self.waste, self.num_full_bags)
+        self._BinPackingGymEnvironment__update_bin_type_distribution_map(action)
+        self.item_size = next_item_size
+
+        self.total_reward += reward
+
+        self.time_remaining -= 1
+        if self.time_remaining == 0:
+            done = True
+
+        info = self._get_info()
+        return self._obs, reward, done, info
 
     def __get_valid_actions(self):
-        valid_actions = list()
         # get bin levels for which bins exist and item will fit
-        for x in range(1, self.action_space.n):
-            if self.num_bins_levels[x] > 0:
-                if x <= (self.bag_capacity - self.item_size):
-                    valid_actions.append(x)
-        valid_actions.append(0)  # open new bag
-        return valid_actions
+        self._mask[:] = self._fit_mask[self.item_size] & (self.num_bins_levels > 0)
+        self._mask[0] = 1  # open new bag
+        return self._mask
+
+
+class VecBinPackingEnv(object):
+    # num_envs copies of BinPackingGymEnvironment stepped in lockstep by a single kernel,
+    # envs whose episode is done are reset inside the kernel.
+    # the bin type distribution map is not tracked here
+
+    def __init__(self, env_config={}):
+
+        config_defaults = {
+            'bag_capacity': 9,
+            'item_sizes': [2, 3],
+            'item_probabilities': [0.8, 0.2],
+            'time_horizon': 1000,
+            'num_envs': 8,
+        }
+
+        for key, val in config_defaults.items():
+            val = env_config.get(key, val)  # Override defaults with constructor parameters
+            self.__dict__[key] = val
+            if key not in env_config:
+                env_config[key] = val
+
+        high = np.full(self.bag_capacity + 1, self.time_horizon, dtype=np.uint32)
+        high[-1] = max(self.item_sizes)
+        self.observation_space = spaces.Box(low=np.zeros(self.bag_capacity + 1, dtype=np.uint32), high=high,
+                                            dtype=np.uint32)
+        self.action_space = spaces.Discrete(self.bag_capacity)
+
+        self._rng = make_rng(env_config.get('seed'))
+        self._item_sizes = np.asarray(self.item_sizes, dtype=np.uint32)
+        self._item_probs = np.asarray(self.item_probabilities)
+
+        # one row per env: number of bags at each level and the item size
+        # NOTE: reset/step return these buffers, copy them if they have to survive the next step
+        self._states = np.zeros((self.num_envs, self.bag_capacity + 1), dtype=np.uint32)
+        self.waste = np.zeros(self.num_envs, dtype=np.int64)
+        self.num_full_bags = np.zeros(self.num_envs, dtype=np.int64)
+        self.time_remaining = np.zeros(self.num_envs, dtype=np.int64)
+        self._rewards = np.zeros(self.num_envs, dtype=np.int64)
+        self._dones = np.zeros(self.num_envs, dtype=np.bool_)
+
+        # pre-drawn items of each env
+        self._item_stream = np.empty((self.num_envs, self.time_horizon + 1), dtype=np.uint32)
+        self._stream_idx = np.zeros(self.num_envs, dtype=np.int64)
+
+    def reset(self):
+        self.__draw_items(np.arange(self.num_envs))
+        self._states.fill(0)
+        self._states[:, -1] = self._item_stream[:, 0]
+        self._stream_idx[:] = 1
+        self.waste.fill(0)
+        self.num_full_bags.fill(0)
+        self.time_remaining.fill(self.time_horizon)
+        return self._states
+
+    def step(self, actions):
+        actions = np.asarray(actions, dtype=np.int64)
+        if (actions >= self.bag_capacity).any():
+            raise ValueError(f"Invalid actions {actions[actions >= self.bag_capacity]}")
+
+        # every env takes one item per step
+        exhausted = np.flatnonzero(self._stream_idx == self._item_stream.shape[1])
+        if exhausted.size:
+            self.__draw_items(exhausted)
+
+        _vec_bp_step(self._states, actions, self.bag_capacity, self.time_horizon, self.waste, self.num_full_bags,
+                     self.time_remaining, self._item_stream, self._stream_idx, self._rewards, self._dones)
+
+        info = {}
+        return self._states, self._rewards, self._dones, info
+
+    def __draw_items(self, envs):
+        item_indices = self._rng.choice(len(self.item_sizes), size=(len(envs), self._item_stream.shape[1]),
+                                        p=self._item_probs)
+        self._item_stream[envs] = self._item_sizes[item_indices]
+        self._stream_idx[envs] = 0
 
 
 if __name__ == '__main__':
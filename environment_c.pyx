@@ -0,0 +1,46 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# compiled numeric core of BinPackingGymEnvironment.step, build it in place with `cythonize -i environment_c.pyx`
+
+# same values as in bin_packing_environment
+cdef int BIG_NEG_REWARD = -100
+cdef int ITEM_PLACED = 0
+cdef int BIN_OVERFLOW = 1
+cdef int NO_BIN_AT_LEVEL = 2
+
+
+cdef class BinPackingCore:
+    # inserts items into the bins of num_bins_levels, same branches as _bp_step_core
+
+    cdef unsigned int[:] num_bins_levels
+    cdef public int bag_capacity, num_full_bags, waste
+
+    def __init__(self, unsigned int[:] num_bins_levels, int bag_capacity):
+        # num_bins_levels is the env's buffer and is updated in place
+        self.num_bins_levels = num_bins_levels
+        self.bag_capacity = bag_capacity
+        self.num_full_bags = 0
+        self.waste = 0
+
+    cpdef tuple step(self, int action, int item_size):
+        # insert the item into a bag of level `action` (0 opens a new bag)
+        # returns reward, num_full_bags, waste and the outcome of the insertion
+        if action > self.bag_capacity - item_size:
+            # can't insert item because bin overflow
+            return BIG_NEG_REWARD - self.waste, self.num_full_bags, self.waste, BIN_OVERFLOW
+        elif action == 0:  # new bag
+            self.num_bins_levels[item_size] += 1
+            # waste = sum of empty spaces in all bags
+            self.waste = self.bag_capacity - item_size
+        elif self.num_bins_levels[action] == 0:
+            # can't insert item because bin of this level doesn't exist
+            return BIG_NEG_REWARD - self.waste, self.num_full_bags, self.waste, NO_BIN_AT_LEVEL
+        else:
+            if action + item_size == self.bag_capacity:
+                self.num_full_bags += 1
+            else:
+                self.num_bins_levels[action + item_size] += 1
+            self.num_bins_levels[action] -= 1
+            # waste = empty space in the bag
+            self.waste = -item_size
+        # reward is negative waste
+        return -self.waste, self.num_full_bags, self.waste, ITEM_PLACED
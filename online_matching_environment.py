@@ -1,21 +1,171 @@
 import os.path
 
+import logging
+
 import gymnasium as gym
 import numpy as np
 from gymnasium import spaces
 
+from utils import attach_shared_arrays, make_rng, masked_obs_buffer, njit, share_arrays
+
+# outcomes of an action of the online vertex, see _match_core
+MATCHED = 0
+NOT_MATCHED = 1
+NOT_NEIGHBOR = 2
+ALREADY_MATCHED = 3
+
+logger = logging.getLogger(__name__)
+
+
+@njit(cache=True)
+def _match_core(matched, adj_mask, action, offline):
+    # match the online vertex to offline vertex `action` (offline means not to match), updating matched in place
+    # returns the reward and the outcome of the action
+    if action == offline:
+        return 0, NOT_MATCHED
+    elif not adj_mask[action]:
+        return 0, NOT_NEIGHBOR
+    elif matched[action] == 1:
+        return 0, ALREADY_MATCHED
+    matched[action] = 1
+    return 1, MATCHED
+
+
+# episode buffers, matching of the online vertex, state assembly and bookkeeping of unmatched actions shared
+# by all matching environments, which set up _adj_rows, the adjacency rows of the online types, themselves
+class MatchingStateMixin(object):
+    def _init_matching_buffers(self, env_config):
+        # an boolean array of offline neighbors that keeps track of unmatched neighbors, cleared on reset
+        self.matched_offline_list = np.zeros(self.offline, dtype=np.uint8)
+        # per episode counts of not matching, matching a non neighbor and matching a matched neighbor,
+        # step returns a copy in info since these keep changing
+        self._invalid_counts = np.zeros(3, dtype=np.int64)
+        self._debug = env_config.get('debug', False)
+        # offline neighbors of the current online vertex, see _set_adj_mask,
+        # kept up to date for the vertex that the next action matches
+        self._adj_mask = np.zeros(self.offline, dtype=np.uint8)
+        # the state is written in place into one preallocated buffer: matched offline vertices, adjacency mask,
+        # online type and arrival time
+        # NOTE: reset/step return this buffer, copy it if it has to survive the next step
+        self._state_buf = np.zeros(2 * self.offline + 2, dtype=np.float32)
+
+    def _match_step(self, action):
+        # match the current online vertex, returns the reward, whether the episode is done and the info
+        done = False
+        # actions may come as single element numpy arrays or torch tensors, the kernel takes a plain int
+        action = int(action.item() if hasattr(action, 'item') else action)
+
+        # the kernel indexes the masks with the action, negative actions would wrap around
+        if not 0 <= action <= self.offline:
+            raise ValueError(f"Invalid action {action}: offline neighbor does not exist")
+
+        # set reward of each step
+        reward, outcome = _match_core(self.matched_offline_list, self._adj_mask, action, self.offline)
+        if outcome == MATCHED:
+            self.rl_matching.append(action + self.online)
+        else:
+            self._log_unmatched_action(action, outcome)
+            self.rl_matching.append(-1)
+
+        self.time_remaining -= 1
+
+        if self.time_remaining == 0:
+            done = True
+
+        info = {'invalid_counts': self._invalid_counts.copy()}
+
+        return reward, done, info
+
+    def _set_adj_mask(self):
+        # look up the cached adjacency row of the current online vertex, no copy
+        self._adj_mask = self._adj_rows[self.online_type]
+
+    def _emit_state(self):
+        # state is the whether offline vertices has already matched and adjancent matrix for current arrival online type,
+        # written into the state buffer for the current online_type and time_remaining
+        self._set_adj_mask()
+        state = self._state_buf
+        state[:self.offline] = self.matched_offline_list
+        state[self.offline:-2] = self._adj_mask
+        state[-2] = self.online_type
+        state[-1] = 1 - self.time_remaining / self.time_horizon
+
+        return state
+
+    def _log_unmatched_action(self, action, outcome):
+        # actions that match nothing are only counted, set 'debug' to also log them
+        self._invalid_counts[outcome - NOT_MATCHED] += 1
+        if self._debug:
+            if outcome == NOT_MATCHED:
+                logger.debug('choose not to match online vertex %s', self.online_type)
+            elif outcome == NOT_NEIGHBOR:
+                logger.debug('offline %s is not a valid neighbor of online vertex %s', action, self.online_type)
+            else:
+                logger.debug('offline neighbor %s already matched', action)
+
+
+# action mask observations shared by the matching environments, subclasses list it before their base
+# environment and call _init_obs_buffer once the base environment is set up
+class ActionMaskMixin(object):
+    def _init_obs_buffer(self, real_obs_space):
+        self.observation_space = spaces.Dict({
+            # a mask of valid actions for adjancent offline neighbors
+            "action_mask": spaces.Box(
+                0,
+                1,
+                shape=(self.action_space.n,),
+                dtype=np.uint8),
+            "real_obs": real_obs_space
+        })
+        # mask and state share one buffer, see masked_obs_buffer, reset/step always return the same dict
+        self._obs_buf, self._mask, self._state = masked_obs_buffer(self.action_space.n, real_obs_space.shape[0],
+                                                                   real_obs_space.dtype)
+        self._mask_valid = self._mask[:-1].view(np.bool_)
+        # the base env writes its state straight into the first 2 * offline + 2 entries of the observation
+        self._state_buf = self._state[:2 * self.offline + 2]
+        self._obs = {
+            "action_mask": self._mask,
+            "real_obs": self._state,
+        }
+
+    def reset(self):
+        super().reset()
+
+        # only assign online vertex to offline neighbors or do not match
+        self._get_valid_actions()
+
+        return self._obs
+
+    def step(self, action):
+        _, reward, done, info = super().step(action)
+
+        self._get_valid_actions()
+
+        return self._obs, reward, done, info
+
+    def _get_valid_actions(self):
+        # only allow match online vertex to its adjancent unmatched offline neighbors
+        # on 0/1 masks, neighbor > matched is neighbor and not matched, computed without temporaries
+        np.greater(self._type_mask[self.online_type, :-1], self.matched_offline_list, out=self._mask_valid)
+
+        # choose not to match the online vertex
+        self._mask[-1] = 1
+
+        return self._mask
+
+
 # basic online graph environment who read graph from file
-class OnlineGraphGymEnvironment(gym.Env):
+class OnlineGraphGymEnvironment(MatchingStateMixin, gym.Env):
     def __init__(self, env_config={}, file_name=''):
         config_defaults = {
             'offline': 100,
             'online': 100,
-            'edges': [],
             'time_horizon': 100,
         }
 
         if not len(file_name):
             file_name = "real_graph/lp_blend/lp_blend.mtx"
+        self.file_name = file_name
 
         for key, val in config_defaults.items():
             val = env_config.get(key, val)  # Override defaults with constructor parameters
@@ -23,87 +173,147 @@ class OnlineGraphGymEnvironment(gym.Env):
             if key not in env_config:
                 env_config[key] = val
 
-        self.read_graph_from_file(file_name)
+        # immutable graph arrays can be shared across vec-env workers, see share_graph
+        self._shared_arrays = {}
+        if env_config.get('shared_graph') is not None:
+            self._shared_blocks, self._shared_arrays = attach_shared_arrays(env_config['shared_graph'])
+            self.edge_indptr = self._shared_arrays['edge_indptr']
+            self.edge_indices = self._shared_arrays['edge_indices']
+            self.offline = self.online = self.time_horizon = (len(self.edge_indptr) - 1) // 2
+        else:
+            self.read_graph_from_file(file_name)
+        # python adjacency lists for Max_matching and Ranking, built on first use, see edges
+        self._edge_lists = None
 
         # state: offline vertices matched or not, the adjancent offline vertices, online vertex number, and arrival time
-        self.observation_space = spaces.Box(low=np.array([0] * (2 * self.offline) + [0] + [0]), high=np.array(
-            [1] * (2 * self.offline) + [self.online] + [1]), dtype=np.uint32)
+        high = np.ones(2 * self.offline + 2, dtype=np.float32)
+        high[-2] = self.online
+        self.observation_space = spaces.Box(low=np.zeros(2 * self.offline + 2, dtype=np.float32), high=high,
+                                            dtype=np.float32)
 
         # actions: choose offline vertices to match or not match to any neighbors
         self.action_space = spaces.Discrete(self.offline + 1)
 
+        # action mask of every online type: its offline neighbors and not matching, fixed once the graph is loaded
+        if 'type_mask' in self._shared_arrays:
+            self._type_mask = self._shared_arrays['type_mask']
+        else:
+            self._type_mask = np.zeros((self.online, self.offline + 1), dtype=np.uint8)
+            degrees = np.diff(self.edge_indptr[:self.online + 1])
+            self._type_mask[np.repeat(np.arange(self.online), degrees),
+                            self.edge_indices[:self.edge_indptr[self.online]] - self.online] = 1
+            self._type_mask[:, -1] = 1
+        # adjacency mask of every online type, a view of _type_mask so rows are built once and reused across resets
+        self._adj_rows = self._type_mask[:, :-1]
 
-    def read_graph_from_file(self, file_name):
+        # all randomness of the arrivals comes from one generator
+        self._rng = make_rng(env_config.get('seed'))
+
+        self._init_matching_buffers(env_config)
 
-        self.edges = []
+    def read_graph_from_file(self, file_name):
 
         with open(file_name, 'r') as rf:
-            all_files = rf.readlines()
-            m, n = all_files[1].split()[1:]
+            rf.readline()
+            m, n = rf.readline().split()[1:]
             m = int(m)
             n = int(n)
-            for i in range(n + n):
-                self.edges.append([])
-            for file in all_files[2:]:
-                x, y = file.split()[:2]
-                x = int(x) - 1
-                y = int(y) - 1
-                self.edges[x].append(y + n)
-                self.edges[y + n].append(x)
+
+            # the rest of the file is the edge list, parsed in one go: online vertex x and offline vertex y per line
+            edge_list = np.loadtxt(rf, usecols=(0, 1), dtype=np.int32, ndmin=2) - 1
+
+        # adjacency in CSR layout, offline vertex y has id y + n:
+        # neighbors of vertex v are edge_indices[edge_indptr[v]:edge_indptr[v + 1]] in file order
+        rows = np.concatenate((edge_list[:, 0], edge_list[:, 1] + n))
+        cols = np.concatenate((edge_list[:, 1] + n, edge_list[:, 0]))
+        order = np.argsort(rows, kind='stable')
+        self.edge_indices = cols[order].astype(np.int32)
+        self.edge_indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=2 * n)))).astype(np.int32)
 
         self.offline = n
         self.online = n
         self.time_horizon = n
 
-    def step(self, action):
-        done = False
-        # set reward of each step
-        reward = 0
-
-        if action > self.offline:
-            print("Error: offline neighbor do not exist.")
-            raise
-
-        elif action == self.offline:
-            # choose not to match online vertex
-            print("choose not to match ")
-
-            self.rl_matching.append(-1)
-
-        elif ((action + self.online) not in self.edges[self.online_type]):
-            print("offline is not a valid neighbor")
-            self.rl_matching.append(-1)
-
-        elif self.matched_offline_list[action] == 1:
-            # can't insert item bin overflow
-            print("offline neighbor already matched ")
-            self.rl_matching.append(-1)
-
-        else:  # match offline neighbors
-            reward = 1
-            self.rl_matching.append(action + self.online)
-            self.matched_offline_list[action] = 1
-
-        self.time_remaining -= 1
-
-        if self.time_remaining == 0:
-            done = True
-        
-        info = None
-
-        return reward, done, info
-
-
+    @property
+    def edges(self):
+        # adjacency lists of python ints, which the pure python Max_matching and Ranking iterate much
+        # faster than numpy slices, built once from the CSR arrays
+        if self._edge_lists is None:
+            self._edge_lists = [row.tolist() for row in np.split(self.edge_indices, self.edge_indptr[1:-1])]
+        return self._edge_lists
+
+    def share_graph(self):
+        # copy the graph arrays into shared memory, pass the returned spec as env_config['shared_graph']
+        # to the workers' envs, the caller keeps the returned blocks alive and unlinks them when done
+        return share_arrays(self._graph_arrays())
+
+    @classmethod
+    def build_shared(cls, file_name='', env_config=None):
+        # load the graph once in the parent process and share it, workers built with the returned spec
+        # as env_config['shared_graph'] skip parsing the file and any other precomputation of the graph
+        env = cls(dict(env_config or {}), file_name)
+        return env.share_graph()
+
+    def _graph_arrays(self):
+        return {'edge_indptr': self.edge_indptr, 'edge_indices': self.edge_indices, 'type_mask': self._type_mask}
 
+    def step(self, action):
+        return self._match_step(action)
+
+
+# lockstep episodes of an online graph environment, the arrival model is given by the two hooks:
+# _reset_online_types_batch(num_envs) draws the arrivals of num_envs new episodes and
+# _next_online_types_batch() returns the array of online types arriving next, one per episode
+class BatchMatchingMixin(object):
+    def reset_batch(self, num_envs):
+        # run num_envs episodes in lockstep, row b of the returned state matrix is the state of episode b
+        # NOTE: step_batch updates this matrix in place, copy it if it has to survive the next step
+        self._batch_rows = np.arange(num_envs)
+        # matched offline vertices plus an always matched column, so that not matching never counts as a match
+        self.matched_batch = np.zeros((num_envs, self.offline + 1), dtype=np.uint8)
+        self.matched_batch[:, -1] = 1
+        self.time_remaining_batch = np.full(num_envs, self.time_horizon, dtype=np.int64)
+        self._state_batch = np.zeros((num_envs, 2 * self.offline + 2), dtype=np.float32)
+
+        self._reset_online_types_batch(num_envs)
+        self.online_type_batch = self._next_online_types_batch()
+
+        return self._get_state_batch()
+
+    def step_batch(self, actions):
+        actions = np.asarray(actions, dtype=np.int64)
+        invalid = (actions < 0) | (actions > self.offline)
+        if invalid.any():
+            raise ValueError(f"Invalid actions {actions[invalid]}: offline neighbor does not exist")
+
+        # a match is valid for an unmatched offline neighbor: on 0/1 masks, neighbor > matched
+        rewards = np.greater(self._type_mask[self.online_type_batch, actions],
+                             self.matched_batch[self._batch_rows, actions]).view(np.uint8)
+        self.matched_batch[self._batch_rows, actions] |= rewards
+
+        self.time_remaining_batch -= 1
+        dones = self.time_remaining_batch == 0
+        # all episodes share the horizon, so they finish together
+        if not dones.all():
+            self.online_type_batch = self._next_online_types_batch()
+
+        return self._get_state_batch(), rewards.astype(np.int64), dones, {}
+
+    def _get_state_batch(self):
+        state = self._state_batch
+        state[:, :self.offline] = self.matched_batch[:, :-1]
+        state[:, self.offline:-2] = self._type_mask[self.online_type_batch, :-1]
+        state[:, -2] = self.online_type_batch
+        state[:, -1] = 1 - self.time_remaining_batch / self.time_horizon
+        return state
 
 
 # online bipartite matching environment
-class OnlineBipartiteMatchingGymEnvironment(OnlineGraphGymEnvironment):
+class OnlineBipartiteMatchingGymEnvironment(BatchMatchingMixin, OnlineGraphGymEnvironment):
     def __init__(self, env_config={}, file_name=''):
         super().__init__(env_config, file_name)
-        self.online_vertex_arrival_order = [i for i in range(self.online)]
-       
-        
+        self.online_vertex_arrival_order = np.arange(self.online, dtype=np.int32)
+
 
     def step(self, action):
         reward, done, info = super().step(action)
@@ -111,13 +321,7 @@ class OnlineBipartiteMatchingGymEnvironment(OnlineGraphGymEnvironment):
         if not done:
             self.online_type = self.__get_online_type()
 
-            adjencent_list = [0] * self.offline
-
-            for y in self.edges[self.online_type]:
-                adjencent_list[y - self.online] = 1
-
-            # state is the whether offline vertices has already matched and adjancent matrix for current arrival online type
-            state = self.matched_offline_list + adjencent_list + [self.online_type] + [1 - self.time_remaining/self.time_horizon]
+            state = self._emit_state()
 
             self.online_type_list.append(self.online_type)
 
@@ -128,11 +332,19 @@ class OnlineBipartiteMatchingGymEnvironment(OnlineGraphGymEnvironment):
         return state, reward, done, info
 
     def __get_online_type(self):
-        return self.online_vertex_arrival_order[self.time_horizon - self.time_remaining]
+        return int(self.online_vertex_arrival_order[self.time_horizon - self.time_remaining])
+
+    def _reset_online_types_batch(self, num_envs):
+        # an independent random arrival order per episode
+        self._arrival_order_batch = np.tile(np.arange(self.online, dtype=np.int32), (num_envs, 1))
+        self._rng.permuted(self._arrival_order_batch, axis=1, out=self._arrival_order_batch)
+
+    def _next_online_types_batch(self):
+        return self._arrival_order_batch[self._batch_rows, self.time_horizon - self.time_remaining_batch]
 
     def reset(self):
 
-        np.random.shuffle(self.online_vertex_arrival_order)
+        self.online_vertex_arrival_order = self._rng.permutation(self.online).astype(np.int32)
 
         self.time_remaining = self.time_horizon
 
@@ -143,61 +355,86 @@ class OnlineBipartiteMatchingGymEnvironment(OnlineGraphGymEnvironment):
         self.online_type_list.append(self.online_type)
 
         self.rl_matching = []
+        self._invalid_counts.fill(0)
 
         # an boolean array of offline neighbors that keeps track of unmatched neighbors upon each online vertex arrival
-        self.matched_offline_list = [0] * self.offline
-
-        # offline neighbors of online vertex
-        adjencent_list = [0] * self.offline
-
-        for y in self.edges[self.online_type]:
-            adjencent_list[y - self.online] = 1
+        self.matched_offline_list.fill(0)
 
-        initial_state = self.matched_offline_list + adjencent_list + [self.online_type] + [0]
-
-        return initial_state
+        return self._emit_state()
 
 # online stochastic matching environment
-class StochasticBipartiteMatchingGymEnvironment(OnlineGraphGymEnvironment):
+class StochasticBipartiteMatchingGymEnvironment(BatchMatchingMixin, OnlineGraphGymEnvironment):
 
     def __init__(self, env_config={}, file_name=''):
         super().__init__(env_config, file_name)
 
-        # set online arrival rate
-        self.__set_online_arrival_rate()
+        # set online arrival rate, uniform over online types unless 'arrival_rate' is given
+        self.__set_online_arrival_rate(env_config.get('arrival_rate'))
     
     def step(self, action):
         reward, done, info = super().step(action)
         # get the next item which differs in different matching model
-        self.online_type = self.__get_online_type()
-
-        adjencent_list = [0] * self.offline
-
-        for y in self.edges[self.online_type]:
-            adjencent_list[y - self.online] = 1
+        if not done:
+            self.online_type = self.__get_online_type()
 
-        # state is the whether offline vertices has already matched and adjancent matrix for current arrival online type
-        state = self.matched_offline_list + adjencent_list + [self.online_type] + [1 - self.time_remaining/self.time_horizon]
+            state = self._emit_state()
+        else:
+            state = None
 
         return state, reward, done, info
 
-    def __set_online_arrival_rate(self):
-        if hasattr(self, 'arrival_rate'):
-            self.online_arrival_rate = self.arrival_rate
+    def _graph_arrays(self):
+        arrays = super()._graph_arrays()
+        arrays['online_arrival_rate'] = self.online_arrival_rate
+        return arrays
+
+    def __set_online_arrival_rate(self, arrival_rate=None):
+        if 'online_arrival_rate' in self._shared_arrays:
+            self.online_arrival_rate = self._shared_arrays['online_arrival_rate']
         else:
-            self.online_arrival_rate = [1] * self.online
+            if arrival_rate is None:
+                arrival_rate = np.ones(self.online, dtype=np.float64)
+            # normalized once into a contiguous float64 array
+            arrival_rate = np.ascontiguousarray(arrival_rate, dtype=np.float64)
+            if arrival_rate.shape != (self.online,):
+                raise ValueError(f"arrival_rate has shape {arrival_rate.shape}, expected ({self.online},)")
+
+            self.online_arrival_rate = arrival_rate / arrival_rate.sum()
+
+        # cumulative arrival rate, online types are sampled by searching uniform draws in it
+        self._cum_arrival_rate = np.cumsum(self.online_arrival_rate)
+        self._cum_arrival_rate /= self._cum_arrival_rate[-1]
+
+    def __sample_online_types(self, num_draws):
+        return np.searchsorted(self._cum_arrival_rate, self._rng.random(num_draws), side='right')
 
-        self.online_arrival_rate = [item / sum(self.online_arrival_rate) for item in self.online_arrival_rate]
+    def _reset_online_types_batch(self, num_envs):
+        # arrivals are independent draws, nothing to prepare per episode
+        pass
+
+    def _next_online_types_batch(self):
+        return self.__sample_online_types(len(self._batch_rows))
+
+    def __draw_online_types(self, num_draws):
+        self._online_type_stream = self.__sample_online_types(num_draws)
+        self._stream_idx = 0
 
     def __get_online_type(self):
+        if self._stream_idx == len(self._online_type_stream):
+            # stepping past the time horizon, draw another batch
+            self.__draw_online_types(self.time_horizon)
 
-        online_type = np.random.choice(self.online, p=self.online_arrival_rate)
+        online_type = int(self._online_type_stream[self._stream_idx])
+        self._stream_idx += 1
 
         return online_type
 
     def reset(self):
         self.time_remaining = self.time_horizon
 
+        # one online type for the initial state and one after every step but the last
+        self.__draw_online_types(self.time_horizon)
+
         self.online_type = self.__get_online_type()
 
         self.online_type_list = []
@@ -205,27 +442,19 @@ class StochasticBipartiteMatchingGymEnvironment(OnlineGraphGymEnvironment):
         self.online_type_list.append(self.online_type)
 
         self.rl_matching = []
+        self._invalid_counts.fill(0)
 
         # an boolean array of offline neighbors that keeps track of unmatched neighbors upon each online vertex arrival
-        self.matched_offline_list = [0] * self.offline
-
-        # offline neighbors of online vertex
-        adjencent_list = [0] * self.offline
-
-        for y in self.edges[self.online_type]:
-            adjencent_list[y - self.online] = 1
+        self.matched_offline_list.fill(0)
 
-        initial_state = self.matched_offline_list + adjencent_list + [self.online_type] + [0]
+        return self._emit_state()
 
-        return initial_state
 
-
-class BipartiteMatchingGymEnvironment_UpperTriangle(gym.Env):
+class BipartiteMatchingGymEnvironment_UpperTriangle(MatchingStateMixin, gym.Env):
     def __init__(self, env_config={}):
         config_defaults = {
             'offline': 100,
             'online': 100,
-            'edges': [],
             'time_horizon': 100,
         }
 
@@ -235,21 +464,30 @@ class BipartiteMatchingGymEnvironment_UpperTriangle(gym.Env):
             if key not in env_config:
                 env_config[key] = val
 
-        print("Start to train on online matching for upper triangle graph")
-
-        self.edges = []
-        for i in range(self.online):
-            online_edge = [self.online + j for j in range(i, self.offline)]
-            self.edges.append(online_edge)
+        if env_config.get('verbose', 0) > 0:
+            print("Start to train on online matching for upper triangle graph")
 
+        # online vertex i is adjacent to every offline vertex j >= i, as ranges of vertex ids for
+        # Max_matching, Ranking and other non-hot paths
+        self.edges = [range(self.online + i, self.online + self.offline) for i in range(self.online)]
 
         # state: offline vertices matched or not, and the adjancent offline vertices
-        self.observation_space = spaces.Box(low=np.array([0] * (2 * self.offline) + [0] + [0]), high=np.array(
-            [1] * (2 * self.offline) + [self.online] + [1]), dtype=np.uint32)
+        high = np.ones(2 * self.offline + 2, dtype=np.float32)
+        high[-2] = self.online
+        self.observation_space = spaces.Box(low=np.zeros(2 * self.offline + 2, dtype=np.float32), high=high,
+                                            dtype=np.float32)
 
         # actions: choose offline vertices to match or not match to any neighbors
         self.action_space = spaces.Discrete(self.offline + 1)
 
+        # action mask of every online type: online type i is adjacent to every offline j >= i, and not matching
+        self._type_mask = np.triu(np.ones((self.online, self.offline + 1), dtype=np.uint8))
+        self._type_mask[:, -1] = 1
+        # the triangular adjacency matrix, its row online_type is the adjacency mask of that online vertex
+        self._adj_rows = self._type_mask[:, :-1]
+
+        self._init_matching_buffers(env_config)
+
     def reset(self):
         self.time_remaining = self.time_horizon
 
@@ -260,277 +498,110 @@ class BipartiteMatchingGymEnvironment_UpperTriangle(gym.Env):
         self.online_type_list.append(self.online_type)
 
         self.rl_matching = []
+        self._invalid_counts.fill(0)
 
         # an boolean array of offline neighbors that keeps track of unmatched neighbors upon each online vertex arrival
-        self.matched_offline_list = [0] * self.offline
-
-        # offline neighbors of online vertex
-        adjencent_list = [0] * self.offline
-        for y in self.edges[self.online_type]:
-            adjencent_list[y - self.online] = 1
-
-        initial_state = self.matched_offline_list + adjencent_list + [self.online_type] + [0]
+        self.matched_offline_list.fill(0)
 
-        return initial_state
+        return self._emit_state()
 
     def step(self, action):
-        done = False
-        # set reward of each step
-        reward = 0
-
-        if action > self.offline:
-            print("Error: offline neighbor do not exist.")
-            raise
-
-        elif action == self.offline:
-            # choose not to match online vertex
-            import pdb 
-            pdb.set_trace()
-            
-            print("choose not to match ")
-            self.rl_matching.append(-1)
-
-        elif ((action + self.online) not in self.edges[self.online_type]):
-            print("offline is not a valid neighbor")
-            self.rl_matching.append(-1)
-
-        elif self.matched_offline_list[action] == 1:
-            # can't insert item bin overflow
-            print("offline neighbor already matched ")
-            self.rl_matching.append(-1)
-
-
-
-        else:  # match offline neighbors
-            reward = 1
-            self.rl_matching.append(action + self.online)
-            self.matched_offline_list[action] = 1
-
-        self.time_remaining -= 1
-
-        if self.time_remaining == 0:
-            done = True
-
+        reward, done, info = self._match_step(action)
 
         state = None
-        info = None
         if not done:
             # get the next item
             self.online_type = self.time_horizon - self.time_remaining
 
-            adjencent_list = [0] * self.offline
-
-            for y in self.edges[self.online_type]:
-                adjencent_list[y - self.online] = 1
-
-            # state is the whether offline vertices has already matched and adjancent matrix for current arrival online type
-            state = self.matched_offline_list + adjencent_list + [self.online_type] + [
-                1 - self.time_remaining / self.time_horizon]
+            state = self._emit_state()
 
             # only add online vertex when not done
             self.online_type_list.append(self.online_type)
 
             self.realsize = len(self.online_type_list)
 
-
         return state, reward, done, info
 
 
-
-
-class BipartiteMatchingActionMaskGymEnvironment_UpperTriangle(BipartiteMatchingGymEnvironment_UpperTriangle):
+class BipartiteMatchingActionMaskGymEnvironment_UpperTriangle(ActionMaskMixin, BipartiteMatchingGymEnvironment_UpperTriangle):
     def __init__(self, env_config={}):
         super().__init__(env_config)
-        self.observation_space = spaces.Dict({
-            # a mask of valid actions for adjancent offline neighbors
-            "action_mask": spaces.Box(
-                0,
-                1,
-                shape=(self.action_space.n,),
-                dtype=np.float32),
-            # original observations
-            "real_obs": self.observation_space
-        })
-
-    def reset(self):
-        state = super().reset()
-
-        # only assign online vertex to offline neighbors or do not match
-        valid_actions = self.__get_valid_actions()
-
-        self.action_mask = [1 if x in valid_actions else 0 for x in range(self.action_space.n)]
-
-        obs = {
-            "action_mask": np.array(self.action_mask),
-            "real_obs": np.array(state),
-        }
+        # the action mask next to the original observations
+        self._init_obs_buffer(self.observation_space)
 
-        return obs
-
-    def step(self, action):
-        state, reward, done, info = super().step(action)
-
-        valid_actions = self.__get_valid_actions()
-
-        self.action_mask = [1 if x in valid_actions else 0 for x in range(self.action_space.n)]
-
-        obs = {
-            "action_mask": np.array(self.action_mask),
-            "real_obs": np.array(state),
-        }
-        return obs, reward, done, info
 
-    def __get_valid_actions(self):
-        valid_actions = list()
-
-        # only allow match online vertex to its adjancent unmatched offline neighbors
-        for y in self.edges[self.online_type]:
-            if not self.matched_offline_list[y - self.online]:
-                valid_actions.append(y - self.online)
-
-        # choose not to match the online vertex
-        valid_actions.append(self.offline)
-
-        return valid_actions
-
-
-class OnlineBipartiteMatchingActionMaskGymEnvironment(OnlineBipartiteMatchingGymEnvironment):
+class OnlineBipartiteMatchingActionMaskGymEnvironment(ActionMaskMixin, OnlineBipartiteMatchingGymEnvironment):
     def __init__(self, env_config={}, file_name=''):
         super().__init__(env_config, file_name)
-        self.observation_space = spaces.Dict({
-            # a mask of valid actions for adjancent offline neighbors
-            "action_mask": spaces.Box(
-                0,
-                1,
-                shape=(self.action_space.n,),
-                dtype=np.float32),
-            # original observations
-            "real_obs": self.observation_space
-        })
-
-    def reset(self):
-        state = super().reset()
-
-        # only assign online vertex to offline neighbors or do not match
-        valid_actions = self.__get_valid_actions()
-
-        self.action_mask = [1 if x in valid_actions else 0 for x in range(self.action_space.n)]
-
-        obs = {
-            "action_mask": np.array(self.action_mask),
-            "real_obs": np.array(state),
-        }
-
-        return obs
-
-    def step(self, action):
-        state, reward, done, info = super().step(action)
-
-        valid_actions = self.__get_valid_actions()
-
-        self.action_mask = [1 if x in valid_actions else 0 for x in range(self.action_space.n)]
-
-        obs = {
-            "action_mask": np.array(self.action_mask),
-            "real_obs": np.array(state),
-        }
-
-        return obs, reward, done, info
-
-    def __get_valid_actions(self):
-        valid_actions = list()
-
-        # only allow match online vertex to its adjancent unmatched offline neighbors
-        for y in self.edges[self.online_type]:
-            if not self.matched_offline_list[y - self.online]:
-                valid_actions.append(y - self.online)
-
-        # choose not to match the online vertex
-        valid_actions.append(self.offline)
-
-        return valid_actions
+        # the action mask next to the original observations
+        self._init_obs_buffer(self.observation_space)
 
 
 from algorithms.Max_matching import Max_matching
 
 
-class StochasticBipartiteMatchingActionMaskGymEnvironment(StochasticBipartiteMatchingGymEnvironment):
+class StochasticBipartiteMatchingActionMaskGymEnvironment(ActionMaskMixin, StochasticBipartiteMatchingGymEnvironment):
     def __init__(self, env_config={}, file_name=''):
         super().__init__(env_config, file_name)
 
         # matching probability of online vertex to offline neighbors
-        self.get_optimal_matching_prob(file_name)
-
+        if 'type_prob_mat' in self._shared_arrays:
+            self.type_prob_mat = self._shared_arrays['type_prob_mat']
+        else:
+            self.get_optimal_matching_prob(self.file_name)
 
-        self.observation_space['real_obs'] = spaces.Box(low=np.array([0] * (3 * self.offline) + [0]), high=np.array(
-            [1] * (3 * self.offline) + [self.online]), dtype=np.float32)
+        # state: offline vertices matched or not, the adjancent offline vertices, matching probability of
+        # the online type to the offline vertices, and arrival time
+        # the online type and arrival time entries the base env writes land on the probability part,
+        # which _emit_state writes afterwards
+        self._init_obs_buffer(spaces.Box(low=np.zeros(3 * self.offline + 1, dtype=np.float32),
+                                         high=np.ones(3 * self.offline + 1, dtype=np.float32), dtype=np.float32))
 
-        # for key in self.type_prob[self.online_type].keys():
-        #     online_type_prob [key - self.online] = self.type_prob[self.online_type][key]
+    def _graph_arrays(self):
+        arrays = super()._graph_arrays()
+        arrays['type_prob_mat'] = self.type_prob_mat
+        return arrays
 
     def optimal_matching_prob(self, sample_num, real_size):
-        self.type_prob = list()
-        for i in range(self.online):
-            self.type_prob.append(dict())
-        for count in range(sample_num):
-            self.realize(real_size)
-            res = Max_matching(self)
-            for i in range(real_size):
-                online_type = self.online_type_list[i]
-                if res[i] != -1:
-                    if res[i] in self.type_prob[online_type]:
-                        self.type_prob[online_type][res[i]] += 1.0 / sample_num
-                    else:
-                        self.type_prob[online_type][res[i]] = 1.0 / sample_num
+        # frequency of each online type being matched to each offline vertex in the max matchings of sampled realizations
+        match_count = np.zeros((self.online, self.offline), dtype=np.int64)
+        # all realizations are drawn in one call into one array, the same draws as sample_num calls of realize
+        realizations = np.random.randint(0, self.online, size=(sample_num, real_size))
+        self.realsize = real_size
+        for online_types in realizations:
+            self.online_type_list = online_types.tolist()
+            res = np.asarray(Max_matching(self))
+            matched = res != -1
+            # every offline vertex is matched at most once per realization, so the pairs are distinct
+            match_count[online_types[matched], res[matched] - self.online] += 1
+        return match_count / sample_num
 
     def realize(self, real_size):
-        self.online_type_list = [0] * real_size
-        for i in range(real_size):
-            self.online_type_list[i] = np.random.randint(0, self.online)
-        self.realsize = len(self.online_type_list)
+        # drawn at once, handed to Max_matching as python ints
+        self.online_type_list = np.random.randint(0, self.online, size=real_size).tolist()
+        self.realsize = real_size
 
     def get_optimal_matching_prob(self, file_name):
 
         wf_name = '/'.join(file_name.split("/")[:-1] + ["edge_with_prob.txt"])
         if os.path.exists(wf_name):
-            self.type_prob = list()
-            for i in range(self.online):
-                self.type_prob.append(dict())
-            with open(wf_name, 'r') as rf:
-                for file in rf.readlines():
-                    i,j,p = file.strip().split(",")
-                    i = int(i)
-                    j = int(j)
-                    p = float(p)
-                    self.type_prob[i][j] = p
+            # lines of online type, offline vertex and probability
+            edge_prob = np.loadtxt(wf_name, delimiter=',', ndmin=2)
+            type_prob = np.zeros((self.online, self.offline))
+            type_prob[edge_prob[:, 0].astype(np.int64), edge_prob[:, 1].astype(np.int64) - self.online] = edge_prob[:, 2]
         else:
-            self.optimal_matching_prob(1000, self.online)
+            type_prob = self.optimal_matching_prob(1000, self.online)
             with open( wf_name, "w" ) as wf:
-                for i in range(self.online):
-                    for k in self.type_prob[i].keys():
-                        wf.writelines( f"{i}, {k}, {self.type_prob[i][k]}\n")
-
-    def reset(self):
-        obs = super().reset()
-
-        online_type_prob = [0] * self.offline
-
-        for key in self.type_prob[self.online_type].keys():
-            online_type_prob [key - self.online] = self.type_prob[self.online_type][key]
-
-        obs['real_obs']  = np.hstack( (obs['real_obs'], online_type_prob))
-
-        return obs
-
-    def step(self, action):
-        obs, reward, done, info = super().step(action)
-
-        online_type_prob = [0] * self.offline
-
-        for key in self.type_prob[self.online_type].keys():
-            online_type_prob [key - self.online] = self.type_prob[self.online_type][key]
+                for i, j in zip(*np.nonzero(type_prob)):
+                    wf.writelines( f"{i}, {j + self.online}, {type_prob[i, j]}\n")
 
-        obs['real_obs']  = np.hstack( (obs['real_obs'], online_type_prob))
+        # matching probability of online type to offline vertex, a row per online type
+        self.type_prob_mat = type_prob.astype(np.float32)
 
-        return obs, reward, done, info
+    def _emit_state(self):
+        super()._emit_state()
+        # the matching probabilities of the online type replace its index and the arrival time moves to the end
+        self._state[2 * self.offline:-1] = self.type_prob_mat[self.online_type]
+        self._state[-1] = 1 - self.time_remaining / self.time_horizon
 
+        return self._state
@@ -1,6 +1,87 @@
+import sys
 from collections import namedtuple
 from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
 from typing import Dict, Any, Optional
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba is optional, without it the jitted kernels run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+    prange = range
+
+
+
+def make_rng(seed=None):
+    # generator for the env's randomness, set 'seed' in env_config for reproducible episodes,
+    # without it the generator is seeded from np.random so that np.random.seed still applies
+    if seed is None:
+        seed = np.random.randint(2 ** 32, dtype=np.uint64)
+    return np.random.default_rng(seed)
+
+
+
+def masked_obs_buffer(mask_len, state_len, state_dtype):
+    # the uint8 action mask and the state share one contiguous byte buffer which is updated in place,
+    # returns the buffer and its mask and state views, the state starts aligned to its item size
+    # NOTE: envs return the same views on every reset/step, copy them if they have to survive the next step
+    itemsize = np.dtype(state_dtype).itemsize
+    mask_bytes = -(-mask_len // itemsize) * itemsize
+    buf = np.zeros(mask_bytes + itemsize * state_len, dtype=np.uint8)
+    return buf, buf[:mask_len], buf[mask_bytes:].view(state_dtype)
+
+
+
+def share_arrays(arrays):
+    # copy each array of the dict into its own shared memory block
+    # returns the blocks, which the owner keeps alive and unlinks when done, and a picklable spec
+    # of block name, shape and dtype per array to pass to attach_shared_arrays in the workers
+    blocks = []
+    spec = {}
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)[:] = arr
+        blocks.append(block)
+        spec[key] = (block.name, arr.shape, arr.dtype.str)
+    return blocks, spec
+
+
+def _attach_untracked(name):
+    # only the owner unlinks the block, so attaching must not register it with the resource tracker, which
+    # unlinks registered blocks when the process exits
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 attaching always registers, and unregistering afterwards would also drop the owner's
+    # registration in forked workers sharing its tracker, so registering is skipped while attaching
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None if rtype == 'shared_memory' else register(name, rtype)
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach_shared_arrays(spec):
+    # read-only views of the arrays of a share_arrays spec, the returned blocks have to outlive the views
+    blocks = []
+    arrays = {}
+    for key, (name, shape, dtype) in spec.items():
+        block = _attach_untracked(name)
+        arr = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        arr.flags.writeable = False
+        blocks.append(block)
+        arrays[key] = arr
+    return blocks, arrays
+
+
 Transition = namedtuple('Transition',
                         ('state', 'action', 'next_state', 'reward'))
 